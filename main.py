@@ -1,6 +1,17 @@
-from flask import Flask, request, render_template, jsonify
+from flask import Flask, request, render_template, jsonify, Response
+from google.api_core import exceptions as google_exceptions
 from google.cloud import vision
+import io
+import json
+import math
 import os
+import sqlite3
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np
 import requests
 from flask_cors import CORS  # Import Flask-CORS
 
@@ -40,60 +51,378 @@ BASE_URL = "https://api.nal.usda.gov/fdc/v1/foods/search"
 os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = 'cs415-442121-1433631f68e7.json'
 vision_client = vision.ImageAnnotatorClient()
 
-#Fetch nutritional information for a food item from USDA FoodData Central
-def get_usda_food_macros(food_name):
+# Bulk job settings: queue location, worker pool size and images per Vision batch request
+JOBS_DB_PATH = os.environ.get('JOBS_DB_PATH', 'jobs.db')
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+VISION_BATCH_SIZE = 16  # Vision API limit for batch_annotate_images
+VISION_BATCH_BYTES = 8 * 1024 * 1024  # keep each batch request well under Vision's request size limit
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 200 * 1024 * 1024))
+MAX_JOB_IMAGES = 1000
+MAX_IMAGE_BYTES = 8 * 1024 * 1024
+MAX_JOB_BYTES = 500 * 1024 * 1024  # total uncompressed size of all images in one job
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')
+JOB_LEASE_SECONDS = 60  # a claimed batch whose lease is not renewed within this is assumed lost and reclaimed
+JOB_LEASE_RENEW_SECONDS = 15
+JOB_INSERT_CHUNK_BYTES = 16 * 1024 * 1024  # uploaded images are written to the queue in transactions of about this size
+JOB_RETENTION_SECONDS = int(os.environ.get('JOB_RETENTION_SECONDS', 7 * 24 * 60 * 60))  # finished jobs are deleted after this
+JOB_SWEEP_SECONDS = 60 * 60
+MAX_JOB_ATTEMPTS = 5  # Vision attempts per image before it is marked failed
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES  # Flask rejects larger uploads with 413
+
+# Upstream resilience settings: how long a caller waits, how long cached data stays fresh
+UPSTREAM_DEADLINE = float(os.environ.get('UPSTREAM_DEADLINE', 3))  # seconds per USDA/TheMealDB/Vision call
+VISION_BATCH_DEADLINE = 30  # batch requests carry up to 16 images
+UPSTREAM_FRESH_TTL = 6 * 60 * 60  # cached responses older than this are revalidated
+UPSTREAM_STALE_TTL = 7 * 24 * 60 * 60  # stale responses are served for at most this long
+
+
+class UpstreamUnavailable(Exception):
+    pass
+
+
+# Vision errors that mean the service is unhealthy or throttling us rather than the request being bad
+TRANSIENT_VISION_ERRORS = (
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.InternalServerError,
+    google_exceptions.RetryError,
+)
+
+
+#Track failures of one upstream API and stop calling it while it is unhealthy
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+        self.lock = threading.Lock()
+
+    # Closed: allow. Open: reject until reset_timeout passes, then let a single probe through
+    def allow_request(self):
+        with self.lock:
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                self.probe_in_flight = False
+            if self.state == 'closed':
+                return True
+            if self.state == 'half_open' and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = 'closed'
+            self.failures = 0
+            self.probe_in_flight = False
+
+    def release_probe(self):
+        with self.lock:
+            self.probe_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self.probe_in_flight = False
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'retry_in': round(max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at)), 1)
+                if self.state == 'open' else 0.0,
+            }
+
+
+breakers = {name: CircuitBreaker(name) for name in ('vision', 'usda', 'themealdb')}
+
+# Stale-while-revalidate cache of upstream responses: (upstream, key) -> (value, fetched_at)
+upstream_cache = {}
+upstream_inflight = {}
+upstream_lock = threading.Lock()
+upstream_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='upstream')
+degraded_state = threading.local()
+
+
+#Start collecting the upstreams that could not be served normally for the current request or job item
+def reset_degraded():
+    degraded_state.upstreams = set()
+
+
+def mark_degraded(name):
+    if not hasattr(degraded_state, 'upstreams'):
+        reset_degraded()
+    degraded_state.upstreams.add(name)
+
+
+def get_degraded():
+    return sorted(getattr(degraded_state, 'upstreams', ()))
+
+
+#Run an upstream fetch in the background pool, sharing one in-flight call per key
+def submit_upstream_fetch(breaker, key, fetch):
+    cache_key = (breaker.name, key)
+
+    def run():
+        started = time.monotonic()
+        try:
+            value = fetch()
+        except Exception:
+            breaker.record_failure()
+            raise
+        finally:
+            with upstream_lock:
+                upstream_inflight.pop(cache_key, None)
+        # A response that arrives after our deadline still fills the cache, but counts against the upstream
+        if time.monotonic() - started > UPSTREAM_DEADLINE:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        with upstream_lock:
+            upstream_cache[cache_key] = (value, time.time())
+        return value
+
+    with upstream_lock:
+        future = upstream_inflight.get(cache_key)
+        if future is None:
+            future = upstream_inflight[cache_key] = upstream_executor.submit(run)
+    return future
+
+
+#Look up an upstream through its circuit breaker without waiting.
+#Returns (value, None) when served from cache or rejected by the breaker, else (None, future).
+def lookup_upstream(name, key, fetch):
+    breaker = breakers[name]
+    with upstream_lock:
+        cached = upstream_cache.get((name, key))
+
+    if cached is not None:
+        value, fetched_at = cached
+        age = time.time() - fetched_at
+        if age < UPSTREAM_FRESH_TTL:
+            return value, None
+        if age < UPSTREAM_STALE_TTL:
+            # Serve stale data now and refresh it in the background
+            if breaker.allow_request():
+                submit_upstream_fetch(breaker, key, fetch)
+            if breaker.state != 'closed':
+                mark_degraded(name)
+            return value, None
+
+    if not breaker.allow_request():
+        mark_degraded(name)
+        return None, None
+
+    return None, submit_upstream_fetch(breaker, key, fetch)
+
+
+#Call several upstreams at once, serving cached data while they are slow or down.
+#All calls share one deadline; a call that misses it returns None and marks its upstream degraded.
+def call_upstreams(calls, deadline=None):
+    if deadline is None:
+        deadline = time.monotonic() + UPSTREAM_DEADLINE
+    results = []
+    pending = []
+    for name, key, fetch in calls:
+        value, future = lookup_upstream(name, key, fetch)
+        results.append(value)
+        pending.append(future)
+
+    futures = {future for future in pending if future is not None}
+    if futures:
+        # Calls still running after the deadline keep going and fill the cache if they succeed
+        wait(futures, timeout=max(0.0, deadline - time.monotonic()))
+
+    for idx, ((name, _, _), future) in enumerate(zip(calls, pending)):
+        if future is None:
+            continue
+        if future.done() and future.exception() is None:
+            results[idx] = future.result()
+        else:
+            mark_degraded(name)
+    return results
+
+
+# USDA nutrient names behind each macro, in the order used for nutrient vectors
+NUTRIENT_NAMES = {
+    "calories": "Energy",
+    "protein": "Protein",
+    "carbs": "Carbohydrate, by difference",
+    "fiber": "Fiber, total dietary",
+}
+NUTRIENT_FIELDS = list(NUTRIENT_NAMES)
+MAX_ITEM_GRAMS = 100_000  # keeps meal totals finite
+
+# Per-100g nutrient vectors parsed from cached USDA records: food name -> (record, vector).
+# The vector is reused until the upstream cache replaces the record it was parsed from.
+nutrient_vectors = {}
+nutrient_vectors_lock = threading.Lock()
+
+#Search USDA FoodData Central and return the best matching food record
+def request_usda_food(food_name):
     params = {
         "query": food_name,
         "pageSize": 1,  # Limit results
         "api_key": API_KEY
     }
-    response = requests.get(BASE_URL, params=params)
-    if response.status_code == 200:
-        data = response.json()
-        if "foods" in data and len(data["foods"]) > 0:
-            food = data["foods"][0]  # Get the first match
-            # Extract macronutrients if available
-            print(food)
-            macros = {
-                "calories": next((f'{nutrient["value"]} {nutrient["unitName"]}' for nutrient in food.get("foodNutrients", []) if
-                                  nutrient.get("nutrientName") == "Energy"), "N/A"),
-                "protein": next((f'{nutrient["value"]} {nutrient["unitName"]}' for nutrient in food.get("foodNutrients", []) if
-                                 nutrient.get("nutrientName") == "Protein"), "N/A"),
-                "carbs": next((f'{nutrient["value"]} {nutrient["unitName"]}' for nutrient in food.get("foodNutrients", []) if
-                               nutrient.get("nutrientName") == "Carbohydrate, by difference"), "N/A"),
-                "fiber": next((f'{nutrient["value"]} {nutrient["unitName"]}' for nutrient in food.get("foodNutrients", []) if
-                               nutrient.get("nutrientName") == "Fiber, total dietary"), "N/A"),
-            }
-            return macros
+    response = requests.get(BASE_URL, params=params, timeout=UPSTREAM_DEADLINE)
+    response.raise_for_status()
+    data = response.json()
+    if "foods" in data and len(data["foods"]) > 0:
+        return data["foods"][0]  # Get the first match
     return None
 
 
-#Get recipes using Spoonacular API for a given ingredient
-def get_recipes_for_ingredient(ingredient):
-    url = f"https://www.themealdb.com/api/json/v1/1/filter.php?i={ingredient}"
+def usda_food_call(food_name):
+    return 'usda', food_name, lambda: request_usda_food(food_name)
 
-    response = requests.get(url)
 
-    recipes =[]
+#Extract the (value, unit) of each macronutrient from a USDA food record
+def parse_usda_nutrients(food):
+    nutrients = {}
+    for nutrient in food.get("foodNutrients", []):
+        name = nutrient.get("nutrientName")
+        # Energy may be reported in both kcal and kJ; keep kcal
+        if name == "Energy" and (nutrient.get("unitName") or "").upper() != "KCAL":
+            continue
+        nutrients.setdefault(name, (nutrient.get("value"), nutrient.get("unitName")))
+    return {field: nutrients[name] for field, name in NUTRIENT_NAMES.items() if name in nutrients}
 
-    if response.status_code == 200:
-        data = response.json()
-        meals = data.get('meals', [])
-        if meals is None:
-            return recipes
-        for meal in meals:
-            recipe = {
-                'title': meal['strMeal'],
-                'url': f"https://www.themealdb.com/meal/{meal['idMeal']}",
-                'image': meal['strMealThumb']
-            }
-            recipes.append(recipe)
+
+#Format the macronutrients of a USDA food record as "value unit" strings
+def format_usda_macros(food):
+    if food is None:
+        return None
+    # Extract macronutrients if available
+    print(food)
+    nutrients = parse_usda_nutrients(food)
+    return {
+        field: f'{nutrients[field][0]} {nutrients[field][1]}' if field in nutrients else "N/A"
+        for field in NUTRIENT_FIELDS
+    }
+
+
+#Get per-100g nutrient vectors for several USDA food names, fetching uncached foods concurrently
+def get_nutrient_vectors(food_names):
+    foods = call_upstreams([usda_food_call(food_name) for food_name in food_names])
+    return [nutrient_vector(food_name, food) for food_name, food in zip(food_names, foods)]
+
+
+#Parse a USDA food record into a per-100g nutrient vector, reusing the last parse of the same record
+def nutrient_vector(food_name, food):
+    if food is None:
+        return None
+    with nutrient_vectors_lock:
+        cached = nutrient_vectors.get(food_name)
+    if cached is not None and cached[0] is food:
+        return cached[1]
+
+    # Nutrients USDA has no value for are NaN so they can be reported as missing rather than 0
+    nutrients = parse_usda_nutrients(food)
+    values = [nutrients.get(field, (None,))[0] for field in NUTRIENT_FIELDS]
+    vector = np.array([np.nan if value is None else float(value) for value in values])
+
+    with nutrient_vectors_lock:
+        nutrient_vectors[food_name] = (food, vector)
+    return vector
+
+
+#Get recipes from TheMealDB for a given ingredient
+def request_recipes_for_ingredient(ingredient):
+    url = f"https://www.themealdb.com/api/json/v1/1/filter.php?i={ingredient}"
+
+    response = requests.get(url, timeout=UPSTREAM_DEADLINE)
+    response.raise_for_status()
+
+    recipes = []
+    meals = response.json().get('meals', [])
+    if meals is None:
+        return recipes
+    for meal in meals:
+        recipe = {
+            'title': meal['strMeal'],
+            'url': f"https://www.themealdb.com/meal/{meal['idMeal']}",
+            'image': meal['strMealThumb']
+        }
+        recipes.append(recipe)
     return recipes
 
+
+def recipes_call(ingredient):
+    return 'themealdb', ingredient.lower(), lambda: request_recipes_for_ingredient(ingredient)
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
+#Build the analysis payload (macros and recipes) for the labels detected in one image
+def analyze_labels(food_items):
+    reset_degraded()
+    filtered_food_items = [item for item in food_items if item.lower() in allowed_foods]
+
+    if len(filtered_food_items) == 0:
+        return {'message': 'No food items found'}
+
+    usda_food_names = [allowed_foods[item.lower()] for item in filtered_food_items]
+    macros = {}
+
+    # Query USDA and TheMealDB for every item at once, bounded by a single deadline
+    responses = call_upstreams(
+        [usda_food_call(item) for item in usda_food_names] +
+        [recipes_call(item) for item in filtered_food_items]
+    )
+    foods, recipe_lists = responses[:len(usda_food_names)], responses[len(usda_food_names):]
+
+    for item, food in zip(usda_food_names, foods):
+        info = format_usda_macros(food)
+        if info:
+            macros[item] = info
+
+    recipes = []
+    for item_recipes in recipe_lists:
+        recipes.extend(item_recipes or [])
+
+    result = {
+        'detected_foods': filtered_food_items,
+        'macros per 100g': macros,
+        'recipes': recipes if recipes else 'no recipes found',
+    }
+    # Flag results that are missing data or built from stale data because an upstream is unhealthy
+    if get_degraded():
+        result['degraded'] = True
+        result['degraded_upstreams'] = get_degraded()
+    return result
+
+
+#Detect labels for one image with the Vision API, failing fast while Vision is unhealthy
+def detect_labels(image_content):
+    breaker = breakers['vision']
+    if not breaker.allow_request():
+        raise UpstreamUnavailable('vision')
+    try:
+        # Retries are left to the breaker and the job queue so our deadline is the only one that applies
+        response = vision_client.label_detection(
+            image=vision.Image(content=image_content), retry=None, timeout=UPSTREAM_DEADLINE)
+    except TRANSIENT_VISION_ERRORS as e:
+        breaker.record_failure()
+        raise UpstreamUnavailable('vision') from e
+    except Exception:
+        # A rejected request says nothing about Vision's health; let the probe slot go
+        breaker.release_probe()
+        raise
+    breaker.record_success()
+    return [label.description for label in response.label_annotations]
+
+
 # Handle food image upload and analysis
 @app.route('/analyze', methods=['POST'])
 def analyze():
@@ -104,44 +433,565 @@ def analyze():
     image_content = image_file.read()
 
     # Perform label detection using Google Vision API
-    image = vision.Image(content=image_content)
-    response = vision_client.label_detection(image=image)
-    labels = response.label_annotations
-
-    # Extract potential food items
-    food_items = [label.description for label in labels]
-    filtered_food_items = [item for item in food_items if item.lower() in allowed_foods]
+    try:
+        food_items = detect_labels(image_content)
+    except UpstreamUnavailable:
+        return jsonify({'error': 'Image recognition is temporarily unavailable', 'degraded': True,
+                        'degraded_upstreams': ['vision']}), 503
+    except google_exceptions.GoogleAPIError as e:
+        return jsonify({'error': f'Image recognition failed: {e}'}), 502
     print(food_items)
 
-    if len(filtered_food_items) == 0:
-        return jsonify({'message': 'No food items found'}), 200
+    return jsonify(analyze_labels(food_items)), 200
 
-    usda_food_names = [allowed_foods[item.lower()] for item in filtered_food_items]
-    macros = {}
 
-    # print(filtered_food_items)
+#Resolve a food name from a meal request to its USDA name
+def resolve_food_name(food):
+    food = str(food).strip().lower()
+    if food in allowed_foods:
+        return allowed_foods[food]
+    if food in allowed_foods.values():
+        return food
+    return None
 
-    for item in usda_food_names:
-        info = get_usda_food_macros(item)
-        if info:
-            macros[item] = info
 
-    recipes = []
-    for item in filtered_food_items:
-        recipes.extend(get_recipes_for_ingredient(item))
+#Round a nutrient vector into a {macro: value} dict; NaN values become null.
+#Nutrients flagged in missing (lacking USDA data for some food) are listed under "missing".
+def nutrient_totals(vector, missing=None):
+    totals = {field: None if np.isnan(value) else round(float(value), 2) for field, value in zip(NUTRIENT_FIELDS, vector)}
+    if missing is None:
+        missing = np.isnan(vector)
+    if missing.any():
+        totals['missing'] = [field for field, flag in zip(NUTRIENT_FIELDS, missing) if flag]
+    return totals
+
+
+# Compute nutrient totals for one meal ("items") or many meals ("meals") of (food, grams) items
+@app.route('/meal', methods=['POST'])
+def meal():
+    reset_degraded()
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Expected a JSON object with "items" or "meals"'}), 400
+    many_meals = isinstance(data.get('meals'), list)
+    if many_meals:
+        meals = data['meals']
+    elif isinstance(data.get('items'), list):
+        meals = [data['items']]
+    else:
+        return jsonify({'error': 'Expected "items" or "meals" list'}), 400
+
+    # Flatten every item into parallel arrays so all meals are computed in one pass
+    food_index = {}
+    item_foods, item_grams, item_meals = [], [], []
+    unknown_foods = set()
+    for meal_idx, items in enumerate(meals):
+        if not isinstance(items, list):
+            return jsonify({'error': f'Meal {meal_idx} must be a list of items'}), 400
+        for item in items:
+            if not isinstance(item, dict) or 'food' not in item:
+                return jsonify({'error': f'Meal {meal_idx} has an item without a food'}), 400
+            grams = item.get('grams', 100)
+            try:
+                # JSON booleans would otherwise be read as 0 or 1 gram
+                grams = -1.0 if isinstance(grams, bool) else float(grams)
+            except (TypeError, ValueError):
+                grams = -1.0
+            if not (math.isfinite(grams) and 0 <= grams <= MAX_ITEM_GRAMS):
+                return jsonify({'error': f'Invalid grams for {item["food"]} in meal {meal_idx}'}), 400
+            food_name = resolve_food_name(item['food'])
+            if food_name is None:
+                unknown_foods.add(str(item['food']))
+                continue
+            item_foods.append(food_index.setdefault(food_name, len(food_index)))
+            item_grams.append(grams)
+            item_meals.append(meal_idx)
+
+    if unknown_foods:
+        return jsonify({'error': 'Unknown foods', 'foods': sorted(unknown_foods)}), 400
+
+    vectors = get_nutrient_vectors(list(food_index))
+    unavailable_foods = [food_name for food_name, vector in zip(food_index, vectors) if vector is None]
+    if unavailable_foods:
+        return jsonify({'error': 'Nutrition data unavailable', 'foods': unavailable_foods,
+                        'degraded_upstreams': get_degraded()}), 502
+
+    per_100g = np.vstack(vectors) if vectors else np.zeros((0, len(NUTRIENT_FIELDS)))
+    contributions = per_100g[np.array(item_foods, dtype=np.intp)] * (np.array(item_grams) / 100.0)[:, None]
+    # Totals add up the known values; nutrients missing for any item in a meal are flagged for that meal,
+    # and a total where every contributing item lacked the nutrient is null
+    item_meals = np.array(item_meals, dtype=np.intp)
+    totals = np.zeros((len(meals), len(NUTRIENT_FIELDS)))
+    np.add.at(totals, item_meals, np.nan_to_num(contributions))
+    missing = np.zeros(totals.shape, dtype=bool)
+    np.logical_or.at(missing, item_meals, np.isnan(contributions))
+    known = np.zeros(totals.shape, dtype=bool)
+    np.logical_or.at(known, item_meals, ~np.isnan(contributions))
+    totals_known = known | ~missing
 
-    if len(recipes) == 0:
-        return jsonify({
-            'detected_foods': filtered_food_items,
-            'macros per 100g': macros,
-            'recipes': 'no recipes found',
-        })
+    if not many_meals:
+        food_names = list(food_index)
+        result = {
+            'items': [
+                {'food': food_name, 'grams': grams, **nutrient_totals(contribution)}
+                for food_name, grams, contribution in zip(
+                    [food_names[idx] for idx in item_foods], item_grams, contributions)
+            ],
+            'totals': nutrient_totals(np.where(totals_known[0], totals[0], np.nan), missing[0]),
+        }
+    else:
+        result = {
+            'meals': [
+                nutrient_totals(meal_totals, meal_missing)
+                for meal_totals, meal_missing in zip(np.where(totals_known, totals, np.nan), missing)
+            ],
+            'totals': nutrient_totals(
+                np.where(known.any(axis=0) | ~missing.any(axis=0), totals.sum(axis=0), np.nan), missing.any(axis=0)),
+        }
+    # Flag totals computed from stale USDA data while USDA is unhealthy
+    if get_degraded():
+        result['degraded'] = True
+        result['degraded_upstreams'] = get_degraded()
+    return jsonify(result), 200
 
+
+# Expose circuit breaker state for monitoring
+@app.route('/health/upstreams', methods=['GET'])
+def upstream_health():
+    with upstream_lock:
+        cached = len(upstream_cache)
     return jsonify({
-        'detected_foods': filtered_food_items,
-        'macros per 100g': macros,
-        'recipes': recipes,
-    })
+        'upstreams': {name: breaker.snapshot() for name, breaker in breakers.items()},
+        'cached_responses': cached,
+    }), 200
+
+
+#Open a connection to the local job queue, creating the tables on first use
+def get_jobs_db():
+    conn = sqlite3.connect(JOBS_DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            created_at REAL NOT NULL,
+            total INTEGER NOT NULL
+        )''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS job_items (
+            job_id TEXT NOT NULL,
+            idx INTEGER NOT NULL,
+            filename TEXT NOT NULL,
+            content BLOB,
+            status TEXT NOT NULL DEFAULT 'pending',
+            claimed_by TEXT,
+            lease_until REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            result TEXT,
+            finished_at REAL,
+            PRIMARY KEY (job_id, idx)
+        )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS job_items_status ON job_items (status, job_id, idx)')
+    return conn
+
+
+class JobTooLarge(Exception):
+    pass
+
+
+#Yield (filename, bytes) for each uploaded image and each image inside uploaded zip archives, one at a time.
+#Sizes are checked against the limits before anything is read or decompressed.
+def iter_job_images(files):
+    count = 0
+    total_bytes = 0
+
+    def check_limits(filename, size):
+        if size > MAX_IMAGE_BYTES:
+            raise JobTooLarge(f'{filename} is larger than {MAX_IMAGE_BYTES} bytes')
+        if count >= MAX_JOB_IMAGES:
+            raise JobTooLarge(f'A job can contain at most {MAX_JOB_IMAGES} images')
+        if total_bytes + size > MAX_JOB_BYTES:
+            raise JobTooLarge(f'A job can contain at most {MAX_JOB_BYTES} bytes of images')
+
+    for uploaded in files:
+        # Uploads are spooled to disk by the server, so archives are read straight from the file
+        stream = uploaded.stream
+        if zipfile.is_zipfile(stream):
+            stream.seek(0)
+            with zipfile.ZipFile(stream) as archive:
+                for entry in archive.infolist():
+                    if not entry.is_dir() and entry.filename.lower().endswith(IMAGE_EXTENSIONS):
+                        check_limits(entry.filename, entry.file_size)
+                        count, total_bytes = count + 1, total_bytes + entry.file_size
+                        yield entry.filename, archive.read(entry)
+        else:
+            stream.seek(0, io.SEEK_END)
+            size = stream.tell()
+            stream.seek(0)
+            if size:
+                check_limits(uploaded.filename, size)
+                count, total_bytes = count + 1, total_bytes + size
+                yield uploaded.filename, stream.read()
+
+
+#Write a chunk of uploaded images to the queue in one short transaction
+def insert_job_items(conn, rows):
+    if not rows:
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    conn.executemany(
+        "INSERT INTO job_items (job_id, idx, filename, content, status) VALUES (?, ?, ?, ?, 'uploading')", rows
+    )
+    conn.execute('COMMIT')
+
+
+#Delete a job and all of its images and results
+def delete_job(conn, job_id):
+    conn.execute('BEGIN IMMEDIATE')
+    conn.execute('DELETE FROM job_items WHERE job_id = ?', (job_id,))
+    deleted = conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,)).rowcount
+    conn.execute('COMMIT')
+    return deleted > 0
+
+
+#Delete jobs that finished (or were abandoned mid-upload) more than JOB_RETENTION_SECONDS ago
+def delete_expired_jobs(conn):
+    cutoff = time.time() - JOB_RETENTION_SECONDS
+    expired = [row['id'] for row in conn.execute(
+        "SELECT id FROM jobs WHERE created_at < ? AND NOT EXISTS ("
+        "SELECT 1 FROM job_items WHERE job_id = jobs.id AND (status IN ('pending', 'running') OR finished_at >= ?))",
+        (cutoff, cutoff)
+    ).fetchall()]
+    for job_id in expired:
+        delete_job(conn, job_id)
+    return len(expired)
+
+
+job_wakeup = threading.Condition()
+job_workers = []
+job_owners = []  # claim owner id of each worker in this process
+job_workers_lock = threading.Lock()
+
+
+#Atomically claim the next batch of pending images, oldest job first.
+#Running images whose lease expired (their worker or process died) are claimed again.
+def claim_job_batch(conn, owner):
+    claimable = "(status = 'pending' OR (status = 'running' AND lease_until < ?))"
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        now = time.time()
+        row = conn.execute(
+            f"SELECT job_id FROM job_items WHERE {claimable} ORDER BY rowid LIMIT 1", (now,)
+        ).fetchone()
+        if row is None:
+            conn.execute('COMMIT')
+            return []
+        candidates = conn.execute(
+            f"SELECT idx, length(content) AS size FROM job_items WHERE job_id = ? AND {claimable} "
+            "ORDER BY idx LIMIT ?", (row['job_id'], now, VISION_BATCH_SIZE)
+        ).fetchall()
+        # Cap the batch by total bytes as well as by count; a single image always fits
+        batch_idx, batch_bytes = [], 0
+        for candidate in candidates:
+            if batch_idx and batch_bytes + (candidate['size'] or 0) > VISION_BATCH_BYTES:
+                break
+            batch_idx.append(candidate['idx'])
+            batch_bytes += candidate['size'] or 0
+        items = conn.execute(
+            f"SELECT job_id, idx, content, attempts FROM job_items WHERE job_id = ? AND idx IN ({','.join('?' * len(batch_idx))}) "
+            "ORDER BY idx", (row['job_id'], *batch_idx)
+        ).fetchall()
+        conn.executemany(
+            "UPDATE job_items SET status = 'running', claimed_by = ?, lease_until = ?, attempts = attempts + 1 "
+            "WHERE job_id = ? AND idx = ?",
+            [(owner, now + JOB_LEASE_SECONDS, item['job_id'], item['idx']) for item in items]
+        )
+        conn.execute('COMMIT')
+        return items
+    except Exception:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+
+
+#Run label detection for a batch of images in a single Vision API call
+def detect_labels_batch(contents):
+    breaker = breakers['vision']
+    if not breaker.allow_request():
+        raise UpstreamUnavailable('vision')
+    feature = vision.Feature(type_=vision.Feature.Type.LABEL_DETECTION)
+    try:
+        batch_response = vision_client.batch_annotate_images(requests=[
+            vision.AnnotateImageRequest(image=vision.Image(content=content), features=[feature])
+            for content in contents
+        ], retry=None, timeout=VISION_BATCH_DEADLINE)
+    except TRANSIENT_VISION_ERRORS as e:
+        breaker.record_failure()
+        raise UpstreamUnavailable('vision') from e
+    except Exception:
+        breaker.release_probe()
+        raise
+    breaker.record_success()
+    results = []
+    for response in batch_response.responses:
+        if response.error.message:
+            results.append(RuntimeError(response.error.message))
+        else:
+            results.append([label.description for label in response.label_annotations])
+    return results
+
+
+#Process one claimed batch and persist each image's result
+def process_job_batch(conn, owner, items):
+    backoff = 0
+    try:
+        detections = detect_labels_batch([item['content'] for item in items])
+    except UpstreamUnavailable as e:
+        # Vision is unhealthy: put the batch back instead of failing the images.
+        # A call the breaker rejected outright does not count as an attempt.
+        attempted = e.__cause__ is not None
+        # item['attempts'] was read before the claim counted this attempt
+        retry = [item for item in items if not attempted or item['attempts'] + 1 < MAX_JOB_ATTEMPTS]
+        conn.executemany(
+            "UPDATE job_items SET status = 'pending', claimed_by = NULL, lease_until = NULL, attempts = attempts - ? "
+            "WHERE job_id = ? AND idx = ? AND claimed_by = ?",
+            [(0 if attempted else 1, item['job_id'], item['idx'], owner) for item in retry]
+        )
+        given_up = [item for item in items if item not in retry]
+        detections = [RuntimeError(f'Vision API unavailable after {MAX_JOB_ATTEMPTS} attempts')] * len(given_up)
+        items = given_up
+        backoff = max(1.0, breakers['vision'].snapshot()['retry_in'])
+    except Exception as e:
+        detections = [e] * len(items)
+
+    for item, labels in zip(items, detections):
+        if isinstance(labels, Exception):
+            status, result = 'failed', {'error': str(labels)}
+        else:
+            try:
+                status, result = 'done', analyze_labels(labels)
+            except Exception as e:
+                status, result = 'failed', {'error': str(e)}
+        # Drop the image bytes once processed so the queue does not grow unbounded.
+        # Only the current lease holder may record a result.
+        conn.execute(
+            "UPDATE job_items SET status = ?, result = ?, content = NULL, finished_at = ? "
+            "WHERE job_id = ? AND idx = ? AND claimed_by = ?",
+            (status, json.dumps(result), time.time(), item['job_id'], item['idx'], owner)
+        )
+
+    # Wait for the breaker to allow a retry before claiming more work
+    if backoff:
+        time.sleep(backoff)
+
+
+#Worker loop: keep claiming batches, sleep until new jobs arrive when idle
+def job_worker(owner):
+    conn = get_jobs_db()
+    while True:
+        items = []
+        try:
+            items = claim_job_batch(conn, owner)
+            if not items:
+                with job_wakeup:
+                    job_wakeup.wait(timeout=5)
+                continue
+            process_job_batch(conn, owner, items)
+        except Exception as e:
+            app.logger.exception('Job worker failed while processing a batch')
+            fail_job_items(conn, owner, items, e)
+            time.sleep(1)
+
+
+#Mark the images still claimed by this worker as failed after an unexpected error.
+#If even that fails (e.g. the database stays locked) their lease expires and they are claimed again.
+def fail_job_items(conn, owner, items, error):
+    try:
+        conn.executemany(
+            "UPDATE job_items SET status = 'failed', result = ?, content = NULL, finished_at = ? "
+            "WHERE job_id = ? AND idx = ? AND claimed_by = ? AND status = 'running'",
+            [(json.dumps({'error': str(error)}), time.time(), item['job_id'], item['idx'], owner) for item in items]
+        )
+    except Exception:
+        app.logger.exception('Could not mark failed job items')
+
+
+#Background upkeep for this process: renew the leases its workers hold so that only
+#batches of a stopped process expire (within JOB_LEASE_SECONDS) and get reclaimed,
+#and periodically delete finished jobs past their retention period
+def job_maintenance():
+    conn = get_jobs_db()
+    last_sweep = 0
+    while True:
+        time.sleep(JOB_LEASE_RENEW_SECONDS)
+        try:
+            conn.executemany(
+                "UPDATE job_items SET lease_until = ? WHERE claimed_by = ? AND status = 'running'",
+                [(time.time() + JOB_LEASE_SECONDS, owner) for owner in job_owners]
+            )
+            if time.monotonic() - last_sweep >= JOB_SWEEP_SECONDS:
+                last_sweep = time.monotonic()
+                delete_expired_jobs(conn)
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            app.logger.exception('Job maintenance failed')
+
+
+#Start the worker pool once; images left running by a stopped process are reclaimed when their lease expires
+def start_job_workers():
+    with job_workers_lock:
+        if job_workers or JOB_WORKERS <= 0:
+            return
+        for _ in range(JOB_WORKERS):
+            owner = uuid.uuid4().hex
+            worker = threading.Thread(target=job_worker, args=(owner,), daemon=True)
+            worker.start()
+            job_owners.append(owner)
+            job_workers.append(worker)
+        maintenance = threading.Thread(target=job_maintenance, daemon=True)
+        maintenance.start()
+        job_workers.append(maintenance)
+
+
+#Summarize a job's progress, optionally including results after a given index
+def get_job_status(conn, job_id, after=-1):
+    job = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    if job is None:
+        return None
+    counts = dict(conn.execute(
+        'SELECT status, COUNT(*) FROM job_items WHERE job_id = ? GROUP BY status', (job_id,)
+    ).fetchall())
+    finished = counts.get('done', 0) + counts.get('failed', 0)
+    if counts.get('uploading'):
+        status = 'uploading'
+    elif finished == job['total']:
+        status = 'completed'
+    else:
+        status = 'running' if finished or counts.get('running') else 'queued'
+    results = [
+        {'index': row['idx'], 'filename': row['filename'], 'status': row['status'], **json.loads(row['result'])}
+        for row in conn.execute(
+            "SELECT idx, filename, status, result FROM job_items "
+            "WHERE job_id = ? AND idx > ? AND status IN ('done', 'failed') ORDER BY idx",
+            (job_id, after)
+        )
+    ]
+    return {
+        'job_id': job_id,
+        'status': status,
+        'total': job['total'],
+        'completed': counts.get('done', 0),
+        'failed': counts.get('failed', 0),
+        'progress': round(finished / job['total'], 4) if job['total'] else 1.0,
+        'results': results,
+    }
+
+
+# Submit a batch of images (or zip archives of images) for background analysis
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    files = request.files.getlist('images') + request.files.getlist('archive')
+    if not files:
+        return jsonify({'error': 'No images uploaded'}), 400
+
+    # Images are written in small transactions as they are read, so workers are never blocked
+    # for long and only one chunk of images is held in memory per upload
+    job_id = uuid.uuid4().hex
+    conn = get_jobs_db()
+    conn.execute('INSERT INTO jobs (id, created_at, total) VALUES (?, ?, 0)', (job_id, time.time()))
+    total = 0
+    try:
+        rows, rows_bytes = [], 0
+        for filename, content in iter_job_images(files):
+            rows.append((job_id, total, filename, content))
+            total += 1
+            rows_bytes += len(content)
+            if rows_bytes >= JOB_INSERT_CHUNK_BYTES:
+                insert_job_items(conn, rows)
+                rows, rows_bytes = [], 0
+        insert_job_items(conn, rows)
+    except (JobTooLarge, zipfile.BadZipFile) as e:
+        delete_job(conn, job_id)
+        conn.close()
+        return jsonify({'error': str(e)}), 413 if isinstance(e, JobTooLarge) else 400
+    except Exception:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        delete_job(conn, job_id)
+        conn.close()
+        raise
+
+    if total == 0:
+        delete_job(conn, job_id)
+        conn.close()
+        return jsonify({'error': 'No images found in upload'}), 400
+
+    # Hand the whole job to the workers at once
+    conn.execute('BEGIN IMMEDIATE')
+    conn.execute("UPDATE job_items SET status = 'pending' WHERE job_id = ? AND status = 'uploading'", (job_id,))
+    conn.execute('UPDATE jobs SET total = ? WHERE id = ?', (total, job_id))
+    conn.execute('COMMIT')
+    conn.close()
+
+    with job_wakeup:
+        job_wakeup.notify_all()
+
+    return jsonify({'job_id': job_id, 'total': total, 'status_url': f'/jobs/{job_id}'}), 202
+
+
+# Delete a job and its results
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def remove_job(job_id):
+    conn = get_jobs_db()
+    deleted = delete_job(conn, job_id)
+    conn.close()
+    if not deleted:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify({'job_id': job_id, 'deleted': True}), 200
+
+
+# Report job progress; ?after=<index> pages results, ?stream=1 streams them as NDJSON
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    after = request.args.get('after', -1, type=int)
+    conn = get_jobs_db()
+    status = get_job_status(conn, job_id, after)
+    if status is None:
+        conn.close()
+        return jsonify({'error': 'Job not found'}), 404
+
+    if request.args.get('stream') not in ('1', 'true'):
+        conn.close()
+        return jsonify(status), 200
+
+    def stream_results(status, after):
+        try:
+            while True:
+                for result in status['results']:
+                    yield json.dumps(result) + '\n'
+                    after = result['index']
+                if status['status'] == 'completed':
+                    break
+                time.sleep(1)
+                status = get_job_status(conn, job_id, after)
+            summary = {key: value for key, value in status.items() if key != 'results'}
+            yield json.dumps(summary) + '\n'
+        finally:
+            conn.close()
+
+    return Response(stream_results(status, after), mimetype='application/x-ndjson')
+
+
+#Application factory for WSGI servers, e.g. gunicorn "main:create_app()".
+#Starts the job workers so queued jobs resume at startup; pass start_workers=False (or set JOB_WORKERS=0) to skip.
+def create_app(start_workers=True):
+    if start_workers:
+        start_job_workers()
+    return app
+
 
 if __name__ == '__main__':
+    # Under the debug reloader only the child process serves requests, so only it runs the job workers
+    create_app(start_workers=os.environ.get('WERKZEUG_RUN_MAIN') == 'true')
     app.run(debug=True)
\ No newline at end of file
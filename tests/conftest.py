@@ -0,0 +1,102 @@
+import os
+import sys
+import threading
+from unittest import mock
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# main builds a Vision client at import time; the tests never talk to Google
+with mock.patch('google.cloud.vision.ImageAnnotatorClient'):
+    import main as main_module
+
+
+class FakeResponse:
+    def __init__(self, payload, status_code=200):
+        self.payload = payload
+        self.status_code = status_code
+
+    def json(self):
+        return self.payload
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f'{self.status_code} error')
+
+
+# Stands in for requests.get, answering USDA searches and TheMealDB lookups from dicts
+class FakeHttp:
+    def __init__(self):
+        self.foods = {}  # USDA query -> food record
+        self.recipes = {}  # ingredient -> list of TheMealDB meals
+        self.status_code = 200
+        self.block = None  # threading.Event the call waits on before answering
+        self.calls = []
+
+    def get(self, url, params=None, timeout=None):
+        if self.block is not None:
+            self.block.wait(timeout=5)
+        if url == main_module.BASE_URL:
+            self.calls.append(('usda', params['query']))
+            food = self.foods.get(params['query'])
+            return FakeResponse({'foods': [food] if food else []}, self.status_code)
+        ingredient = url.split('i=', 1)[1]
+        self.calls.append(('themealdb', ingredient))
+        return FakeResponse({'meals': self.recipes.get(ingredient)}, self.status_code)
+
+
+@pytest.fixture
+def main(monkeypatch, tmp_path):
+    monkeypatch.setattr(main_module, 'JOBS_DB_PATH', str(tmp_path / 'jobs.db'))
+    monkeypatch.setattr(main_module, 'UPSTREAM_DEADLINE', 0.5)
+    monkeypatch.setattr(main_module, 'vision_client', mock.MagicMock())
+    monkeypatch.setattr(main_module, 'breakers', {
+        name: main_module.CircuitBreaker(name) for name in ('vision', 'usda', 'themealdb')
+    })
+    monkeypatch.setattr(main_module, 'print', lambda *args: None, raising=False)
+    main_module.upstream_cache.clear()
+    main_module.upstream_inflight.clear()
+    main_module.nutrient_vectors.clear()
+    main_module.reset_degraded()
+    yield main_module
+    main_module.upstream_cache.clear()
+    main_module.upstream_inflight.clear()
+
+
+@pytest.fixture
+def http(main, monkeypatch):
+    fake = FakeHttp()
+    monkeypatch.setattr(main.requests, 'get', fake.get)
+    yield fake
+    # Let any call still waiting in the background finish
+    if fake.block is not None:
+        fake.block.set()
+
+
+@pytest.fixture
+def client(main):
+    return main.app.test_client()
+
+
+def usda_food(**nutrients):
+    names = {
+        'calories': ('Energy', 'KCAL'),
+        'protein': ('Protein', 'G'),
+        'carbs': ('Carbohydrate, by difference', 'G'),
+        'fiber': ('Fiber, total dietary', 'G'),
+    }
+    return {'foodNutrients': [
+        {'nutrientName': names[field][0], 'unitName': names[field][1], 'value': value}
+        for field, value in nutrients.items()
+    ]}
+
+
+def wait_for(predicate, timeout=2.0):
+    event = threading.Event()
+    for _ in range(int(timeout / 0.01)):
+        if predicate():
+            return True
+        event.wait(0.01)
+    return predicate()
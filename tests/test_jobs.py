@@ -0,0 +1,183 @@
+import io
+import json
+import time
+import zipfile
+
+import pytest
+from google.cloud import vision
+
+
+def labels_response(*labels_per_image):
+    return vision.BatchAnnotateImagesResponse(responses=[
+        vision.AnnotateImageResponse(label_annotations=[vision.EntityAnnotation(description=label) for label in labels])
+        for labels in labels_per_image
+    ])
+
+
+def add_job(conn, job_id, contents):
+    conn.execute('INSERT INTO jobs (id, created_at, total) VALUES (?, ?, ?)', (job_id, time.time(), len(contents)))
+    conn.executemany(
+        'INSERT INTO job_items (job_id, idx, filename, content) VALUES (?, ?, ?, ?)',
+        [(job_id, idx, f'{idx}.jpg', content) for idx, content in enumerate(contents)]
+    )
+
+
+def zip_upload(files):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name, content in files.items():
+            archive.writestr(name, content)
+    buffer.seek(0)
+    return buffer
+
+
+@pytest.fixture
+def conn(main):
+    conn = main.get_jobs_db()
+    yield conn
+    conn.close()
+
+
+def test_import_does_not_start_workers(main):
+    assert main.job_workers == []
+    assert main.create_app(start_workers=False) is main.app
+    assert main.job_workers == []
+
+
+def test_claim_takes_oldest_job_first_and_leases_items(main, conn):
+    add_job(conn, 'first', [b'a'] * 3)
+    add_job(conn, 'second', [b'b'])
+
+    items = main.claim_job_batch(conn, 'worker-1')
+
+    assert [(item['job_id'], item['idx']) for item in items] == [('first', 0), ('first', 1), ('first', 2)]
+    rows = conn.execute("SELECT status, claimed_by, lease_until, attempts FROM job_items WHERE job_id = 'first'").fetchall()
+    assert all(row['status'] == 'running' and row['claimed_by'] == 'worker-1' for row in rows)
+    assert all(row['lease_until'] > time.time() and row['attempts'] == 1 for row in rows)
+    assert [item['job_id'] for item in main.claim_job_batch(conn, 'worker-2')] == ['second']
+    assert main.claim_job_batch(conn, 'worker-3') == []
+
+
+def test_claim_caps_batch_by_count_and_bytes(main, conn, monkeypatch):
+    monkeypatch.setattr(main, 'VISION_BATCH_SIZE', 4)
+    monkeypatch.setattr(main, 'VISION_BATCH_BYTES', 25)
+    add_job(conn, 'job', [b'x' * 10] * 3 + [b'x' * 100] + [b'x'] * 6)
+
+    batches = [[item['idx'] for item in main.claim_job_batch(conn, 'worker')] for _ in range(4)]
+
+    # The oversized image still goes out, alone
+    assert batches == [[0, 1], [2], [3], [4, 5, 6, 7]]
+
+
+def test_expired_lease_is_reclaimed_and_old_owner_cannot_write(main, conn, http):
+    add_job(conn, 'job', [b'a'])
+    stale_items = main.claim_job_batch(conn, 'dead-worker')
+    assert main.claim_job_batch(conn, 'live-worker') == []
+
+    conn.execute("UPDATE job_items SET lease_until = 0")
+    items = main.claim_job_batch(conn, 'live-worker')
+    assert [item['idx'] for item in items] == [0]
+
+    main.vision_client.batch_annotate_images.return_value = labels_response(['Rock'])
+    main.process_job_batch(conn, 'dead-worker', stale_items)
+    assert conn.execute('SELECT status, claimed_by FROM job_items').fetchone()[:] == ('running', 'live-worker')
+
+    main.process_job_batch(conn, 'live-worker', items)
+    assert conn.execute('SELECT status FROM job_items').fetchone()[0] == 'done'
+
+
+def test_process_job_batch_stores_results_and_drops_images(main, conn, http):
+    http.recipes['Banana'] = [{'strMeal': 'Banana bread', 'idMeal': '1', 'strMealThumb': 'thumb'}]
+    add_job(conn, 'job', [b'a', b'b'])
+    main.vision_client.batch_annotate_images.return_value = labels_response(['Banana'], ['Rock'])
+
+    main.process_job_batch(conn, 'worker', main.claim_job_batch(conn, 'worker'))
+
+    status = main.get_job_status(conn, 'job')
+    assert status['status'] == 'completed' and status['completed'] == 2
+    assert status['results'][0]['detected_foods'] == ['Banana']
+    assert status['results'][0]['recipes'][0]['title'] == 'Banana bread'
+    assert status['results'][1]['message'] == 'No food items found'
+    assert conn.execute('SELECT COUNT(*) FROM job_items WHERE content IS NOT NULL').fetchone()[0] == 0
+
+
+def test_fail_job_items_only_touches_own_running_items(main, conn):
+    add_job(conn, 'job', [b'a', b'b'])
+    items = main.claim_job_batch(conn, 'worker')
+    conn.execute("UPDATE job_items SET claimed_by = 'other' WHERE idx = 1")
+
+    main.fail_job_items(conn, 'worker', items, RuntimeError('boom'))
+
+    rows = conn.execute('SELECT status, result FROM job_items ORDER BY idx').fetchall()
+    assert rows[0]['status'] == 'failed' and json.loads(rows[0]['result']) == {'error': 'boom'}
+    assert rows[1]['status'] == 'running'
+
+
+def test_create_job_from_archive_and_images(main, client, conn):
+    archive = zip_upload({'a.jpg': b'a', 'nested/b.png': b'b', 'notes.txt': b'skip'})
+    response = client.post('/jobs', data={
+        'archive': (archive, 'meals.zip'),
+        'images': (io.BytesIO(b'c'), 'c.jpeg'),
+    }, content_type='multipart/form-data')
+
+    assert response.status_code == 202
+    job_id = response.get_json()['job_id']
+    assert response.get_json()['total'] == 3
+    rows = conn.execute('SELECT filename, status FROM job_items WHERE job_id = ? ORDER BY idx', (job_id,)).fetchall()
+    assert [tuple(row) for row in rows] == [('c.jpeg', 'pending'), ('a.jpg', 'pending'), ('nested/b.png', 'pending')]
+    assert client.get(f'/jobs/{job_id}').get_json()['status'] == 'queued'
+
+
+def test_create_job_over_limits_is_rejected_and_rolled_back(main, client, conn, monkeypatch):
+    monkeypatch.setattr(main, 'MAX_JOB_IMAGES', 2)
+    monkeypatch.setattr(main, 'JOB_INSERT_CHUNK_BYTES', 1)
+    archive = zip_upload({f'{idx}.jpg': b'x' for idx in range(3)})
+
+    response = client.post('/jobs', data={'archive': (archive, 'a.zip')}, content_type='multipart/form-data')
+
+    assert response.status_code == 413
+    assert conn.execute('SELECT COUNT(*) FROM jobs').fetchone()[0] == 0
+    assert conn.execute('SELECT COUNT(*) FROM job_items').fetchone()[0] == 0
+
+
+def test_archive_entry_size_is_checked_before_decompressing(main, client, monkeypatch):
+    monkeypatch.setattr(main, 'MAX_IMAGE_BYTES', 100)
+    archive = zip_upload({'big.jpg': b'\0' * 1000})
+
+    response = client.post('/jobs', data={'archive': (archive, 'a.zip')}, content_type='multipart/form-data')
+
+    assert response.status_code == 413
+    assert 'big.jpg' in response.get_json()['error']
+
+
+def test_create_job_without_images(client):
+    assert client.post('/jobs').status_code == 400
+    response = client.post('/jobs', data={'archive': (zip_upload({'a.txt': b'x'}), 'a.zip')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 400
+
+
+def test_get_job_pages_and_streams_results(main, client, conn, http):
+    add_job(conn, 'job', [b'a', b'b'])
+    main.vision_client.batch_annotate_images.return_value = labels_response(['Rock'], ['Rock'])
+    main.process_job_batch(conn, 'worker', main.claim_job_batch(conn, 'worker'))
+
+    assert [result['index'] for result in client.get('/jobs/job?after=0').get_json()['results']] == [1]
+    lines = [json.loads(line) for line in client.get('/jobs/job?stream=1').get_data(as_text=True).splitlines()]
+    assert [line.get('index') for line in lines] == [0, 1, None]
+    assert lines[-1]['status'] == 'completed'
+    assert client.get('/jobs/missing').status_code == 404
+
+
+def test_delete_and_expire_jobs(main, client, conn):
+    add_job(conn, 'old', [b'a'])
+    add_job(conn, 'active', [b'b'])
+    add_job(conn, 'deleted', [b'c'])
+    conn.execute("UPDATE jobs SET created_at = 0")
+    conn.execute("UPDATE job_items SET status = 'done', result = '{}', finished_at = 0 WHERE job_id = 'old'")
+
+    assert main.delete_expired_jobs(conn) == 1
+    assert client.delete('/jobs/deleted').status_code == 200
+    assert client.delete('/jobs/deleted').status_code == 404
+    assert [row[0] for row in conn.execute('SELECT id FROM jobs')] == ['active']
+    assert [row[0] for row in conn.execute('SELECT DISTINCT job_id FROM job_items')] == ['active']
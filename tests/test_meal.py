@@ -0,0 +1,105 @@
+import pytest
+
+from conftest import usda_food
+
+
+@pytest.fixture
+def foods(http):
+    http.foods['banana, raw'] = usda_food(calories=89, protein=1.1, carbs=22.8, fiber=2.6)
+    http.foods['eggs, raw'] = usda_food(calories=143, protein=12.6, carbs=0.7)
+    return http
+
+
+def test_single_meal_scales_items_by_grams(client, foods):
+    response = client.post('/meal', json={'items': [{'food': 'banana', 'grams': 150}, {'food': 'Egg', 'grams': 50}]})
+
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['items'][0] == {'food': 'banana, raw', 'grams': 150.0,
+                                'calories': 133.5, 'protein': 1.65, 'carbs': 34.2, 'fiber': 3.9}
+    assert data['totals']['calories'] == 205.0
+    assert data['totals']['protein'] == 7.95
+
+
+def test_many_meals_return_per_meal_and_grand_totals(client, foods):
+    response = client.post('/meal', json={'meals': [
+        [{'food': 'banana', 'grams': 100}],
+        [{'food': 'banana, raw', 'grams': 200}, {'food': 'egg'}],
+        [],
+    ]})
+
+    data = response.get_json()
+    assert [meal['calories'] for meal in data['meals']] == [89.0, 321.0, 0.0]
+    assert data['totals']['calories'] == 410.0
+    assert 'items' not in data
+
+
+def test_totals_for_thousands_of_meals(client, foods):
+    meals = [[{'food': 'banana', 'grams': 100}, {'food': 'egg', 'grams': 100}]] * 5000
+
+    data = client.post('/meal', json={'meals': meals}).get_json()
+
+    assert len(data['meals']) == 5000
+    assert data['totals']['calories'] == 5000 * (89 + 143)
+    # Each food is fetched from USDA only once
+    assert sorted(foods.calls) == [('usda', 'banana, raw'), ('usda', 'eggs, raw')]
+
+
+def test_null_meals_falls_back_to_single_meal_shape(client, foods):
+    data = client.post('/meal', json={'meals': None, 'items': [{'food': 'banana'}]}).get_json()
+
+    assert data['items'][0]['grams'] == 100.0
+    assert 'meals' not in data
+
+
+@pytest.mark.parametrize('body', [[{'food': 'apple'}], 'x', {}, {'items': 'banana'}, {'meals': [{'food': 'egg'}]},
+                                  {'items': [{'grams': 10}]}])
+def test_malformed_bodies_are_rejected(client, foods, body):
+    assert client.post('/meal', json=body).status_code == 400
+
+
+@pytest.mark.parametrize('grams', ['inf', float('inf'), 'nan', True, -1, 100_001, 'lots', None])
+def test_invalid_grams_are_rejected(client, foods, grams):
+    response = client.post('/meal', json={'items': [{'food': 'banana', 'grams': grams}]})
+
+    assert response.status_code == 400
+    assert 'Invalid grams' in response.get_json()['error']
+
+
+def test_unknown_foods_are_listed(client, foods):
+    response = client.post('/meal', json={'items': [{'food': 'steak'}, {'food': 'banana'}, {'food': 'tofu'}]})
+
+    assert response.status_code == 400
+    assert response.get_json()['foods'] == ['steak', 'tofu']
+
+
+def test_missing_nutrients_are_null_and_listed(client, foods):
+    data = client.post('/meal', json={'items': [{'food': 'egg', 'grams': 100}]}).get_json()
+
+    assert data['items'][0]['fiber'] is None
+    assert data['items'][0]['missing'] == ['fiber']
+    assert data['totals']['fiber'] is None
+
+    data = client.post('/meal', json={'items': [{'food': 'egg'}, {'food': 'banana'}]}).get_json()
+    assert data['totals']['fiber'] == 2.6
+    assert data['totals']['missing'] == ['fiber']
+
+
+def test_energy_is_taken_in_kcal(client, http):
+    http.foods['apple, raw'] = {'foodNutrients': [
+        {'nutrientName': 'Energy', 'unitName': 'kJ', 'value': 218},
+        {'nutrientName': 'Energy', 'unitName': None, 'value': 1},
+        {'nutrientName': 'Energy', 'unitName': 'KCAL', 'value': 52},
+        {'nutrientName': 'Protein', 'unitName': 'G', 'value': 0.3},
+    ]}
+
+    data = client.post('/meal', json={'items': [{'food': 'apple'}]}).get_json()
+
+    assert data['totals']['calories'] == 52.0
+
+
+def test_unavailable_nutrition_data_returns_502(client, foods):
+    response = client.post('/meal', json={'items': [{'food': 'kiwi'}]})
+
+    assert response.status_code == 502
+    assert response.get_json()['foods'] == ['kiwi, raw']
@@ -0,0 +1,293 @@
+import io
+import threading
+import time
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+from google.cloud import vision
+
+from conftest import usda_food, wait_for
+from test_jobs import add_job
+
+
+def open_breaker(breaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+
+
+def age_cache_entry(main, name, key, age):
+    value, _ = main.upstream_cache[(name, key)]
+    main.upstream_cache[(name, key)] = (value, time.time() - age)
+
+
+# Circuit breaker
+
+def test_breaker_opens_after_threshold_and_rejects(main):
+    breaker = main.CircuitBreaker('test', failure_threshold=3, reset_timeout=30)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.allow_request() and breaker.state == 'closed'
+
+    breaker.record_failure()
+
+    assert breaker.state == 'open'
+    assert not breaker.allow_request()
+    assert 29 < breaker.snapshot()['retry_in'] <= 30
+
+
+def test_breaker_half_open_allows_single_probe(main):
+    breaker = main.CircuitBreaker('test', failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    breaker.opened_at -= 31
+
+    assert breaker.allow_request()
+    assert breaker.state == 'half_open'
+    assert not breaker.allow_request()
+
+    breaker.release_probe()
+    assert breaker.allow_request()
+
+
+def test_breaker_probe_success_closes_and_failure_reopens(main):
+    breaker = main.CircuitBreaker('test', failure_threshold=2, reset_timeout=30)
+    open_breaker(breaker)
+    breaker.opened_at -= 31
+    assert breaker.allow_request()
+
+    breaker.record_failure()
+    assert breaker.state == 'open' and not breaker.allow_request()
+
+    breaker.opened_at -= 31
+    assert breaker.allow_request()
+    breaker.record_success()
+    assert breaker.snapshot() == {'state': 'closed', 'failures': 0, 'retry_in': 0.0}
+
+
+def test_success_resets_failure_count(main):
+    breaker = main.CircuitBreaker('test', failure_threshold=2)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == 'closed'
+
+
+# Stale-while-revalidate cache
+
+def test_fresh_cache_is_served_without_calling(main):
+    calls = []
+    assert main.call_upstreams([('usda', 'k', lambda: calls.append(1) or 'v')]) == ['v']
+    assert main.call_upstreams([('usda', 'k', lambda: calls.append(1) or 'new')]) == ['v']
+    assert calls == [1]
+    assert main.get_degraded() == []
+
+
+def test_stale_cache_is_served_and_refreshed_in_background(main):
+    main.call_upstreams([('usda', 'k', lambda: 'old')])
+    age_cache_entry(main, 'usda', 'k', main.UPSTREAM_FRESH_TTL + 1)
+
+    assert main.call_upstreams([('usda', 'k', lambda: 'new')]) == ['old']
+    assert main.get_degraded() == []
+    assert wait_for(lambda: main.upstream_cache[('usda', 'k')][0] == 'new')
+
+
+def test_stale_cache_is_served_as_degraded_while_breaker_open(main):
+    main.call_upstreams([('usda', 'k', lambda: 'old')])
+    age_cache_entry(main, 'usda', 'k', main.UPSTREAM_FRESH_TTL + 1)
+    open_breaker(main.breakers['usda'])
+    calls = []
+
+    assert main.call_upstreams([('usda', 'k', lambda: calls.append(1) or 'new')]) == ['old']
+    assert main.get_degraded() == ['usda']
+    assert calls == []
+
+
+def test_expired_cache_is_fetched_again(main):
+    main.call_upstreams([('usda', 'k', lambda: 'old')])
+    age_cache_entry(main, 'usda', 'k', main.UPSTREAM_STALE_TTL + 1)
+
+    assert main.call_upstreams([('usda', 'k', lambda: 'new')]) == ['new']
+
+
+def test_open_breaker_fails_fast_without_cache(main):
+    open_breaker(main.breakers['themealdb'])
+    calls = []
+
+    assert main.call_upstreams([('themealdb', 'egg', lambda: calls.append(1))]) == [None]
+    assert main.get_degraded() == ['themealdb']
+    assert calls == []
+
+
+def test_failed_fetch_is_degraded_and_counts_against_breaker(main):
+    def fail():
+        raise RuntimeError('down')
+
+    assert main.call_upstreams([('usda', 'k', fail)]) == [None]
+    assert main.get_degraded() == ['usda']
+    assert main.breakers['usda'].failures == 1
+    assert ('usda', 'k') not in main.upstream_cache
+
+
+def test_calls_share_one_deadline(main, monkeypatch):
+    monkeypatch.setattr(main, 'UPSTREAM_DEADLINE', 0.2)
+    release = threading.Event()
+
+    def slow(value):
+        release.wait(timeout=5)
+        return value
+
+    started = time.monotonic()
+    results = main.call_upstreams([('usda', key, lambda key=key: slow(key)) for key in 'abcd'])
+    elapsed = time.monotonic() - started
+
+    assert results == [None] * 4
+    assert elapsed < 0.5
+    assert main.get_degraded() == ['usda']
+
+    # Late answers still fill the cache but count as failures
+    time.sleep(0.1)
+    release.set()
+    assert wait_for(lambda: all(('usda', key) in main.upstream_cache for key in 'abcd'))
+    assert main.breakers['usda'].failures == 4
+
+
+def test_concurrent_lookups_share_one_inflight_fetch(main):
+    release = threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        release.wait(timeout=5)
+        return 'v'
+
+    threads = [threading.Thread(target=main.call_upstreams, args=([('usda', 'k', fetch)],)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    wait_for(lambda: calls)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [1]
+
+
+def test_analyze_labels_marks_missing_upstream_data_degraded(main, http):
+    http.foods['banana, raw'] = usda_food(calories=89)
+    http.recipes['Banana'] = [{'strMeal': 'Banana bread', 'idMeal': '1', 'strMealThumb': 'thumb'}]
+    assert 'degraded' not in main.analyze_labels(['Banana'])
+
+    http.status_code = 500
+    result = main.analyze_labels(['Apple'])
+
+    assert result['macros per 100g'] == {}
+    assert result['recipes'] == 'no recipes found'
+    assert result['degraded_upstreams'] == ['themealdb', 'usda']
+
+
+def test_upstream_health_reports_breakers(main, client):
+    open_breaker(main.breakers['usda'])
+
+    upstreams = client.get('/health/upstreams').get_json()['upstreams']
+
+    assert upstreams['usda']['state'] == 'open'
+    assert upstreams['vision']['state'] == 'closed'
+
+
+# Vision in /analyze
+
+def post_image(client):
+    return client.post('/analyze', data={'image': (io.BytesIO(b'img'), 'a.jpg')}, content_type='multipart/form-data')
+
+
+def test_analyze_detects_labels_without_client_retries(main, client, http):
+    main.vision_client.label_detection.return_value = vision.AnnotateImageResponse(
+        label_annotations=[vision.EntityAnnotation(description='Rock')])
+
+    response = post_image(client)
+
+    assert response.get_json() == {'message': 'No food items found'}
+    assert main.vision_client.label_detection.call_args.kwargs['retry'] is None
+
+
+@pytest.mark.parametrize('error', [
+    google_exceptions.DeadlineExceeded('slow'),
+    google_exceptions.ServiceUnavailable('down'),
+    google_exceptions.ResourceExhausted('quota'),
+    google_exceptions.InternalServerError('oops'),
+    google_exceptions.RetryError('gave up', None),
+])
+def test_analyze_transient_vision_errors_return_503_and_count(main, client, error):
+    main.vision_client.label_detection.side_effect = error
+
+    response = post_image(client)
+
+    assert response.status_code == 503
+    assert response.get_json()['degraded_upstreams'] == ['vision']
+    assert main.breakers['vision'].failures == 1
+
+
+def test_analyze_rejected_request_returns_502_without_tripping_breaker(main, client):
+    main.vision_client.label_detection.side_effect = google_exceptions.InvalidArgument('bad image')
+
+    assert post_image(client).status_code == 502
+    assert main.breakers['vision'].failures == 0
+
+
+def test_analyze_fails_fast_while_vision_breaker_open(main, client):
+    open_breaker(main.breakers['vision'])
+
+    assert post_image(client).status_code == 503
+    main.vision_client.label_detection.assert_not_called()
+
+
+# Vision in bulk jobs
+
+@pytest.fixture
+def conn(main, monkeypatch):
+    monkeypatch.setattr(main.time, 'sleep', lambda seconds: None)
+    conn = main.get_jobs_db()
+    yield conn
+    conn.close()
+
+
+def job_rows(conn):
+    return [tuple(row) for row in conn.execute('SELECT status, attempts FROM job_items ORDER BY idx')]
+
+
+def test_transient_batch_error_requeues_until_attempts_run_out(main, conn):
+    main.breakers['vision'].failure_threshold = 100
+    main.vision_client.batch_annotate_images.side_effect = google_exceptions.ResourceExhausted('quota')
+    add_job(conn, 'job', [b'a', b'b'])
+
+    main.process_job_batch(conn, 'worker', main.claim_job_batch(conn, 'worker'))
+    assert job_rows(conn) == [('pending', 1), ('pending', 1)]
+
+    while items := main.claim_job_batch(conn, 'worker'):
+        main.process_job_batch(conn, 'worker', items)
+
+    assert main.vision_client.batch_annotate_images.call_count == main.MAX_JOB_ATTEMPTS
+    assert job_rows(conn) == [('failed', main.MAX_JOB_ATTEMPTS)] * 2
+    assert main.get_job_status(conn, 'job')['status'] == 'completed'
+    assert main.vision_client.batch_annotate_images.call_args.kwargs['retry'] is None
+
+
+def test_permanent_batch_error_fails_items_without_tripping_breaker(main, conn):
+    main.vision_client.batch_annotate_images.side_effect = google_exceptions.InvalidArgument('request too large')
+    add_job(conn, 'job', [b'a'])
+
+    main.process_job_batch(conn, 'worker', main.claim_job_batch(conn, 'worker'))
+
+    status = main.get_job_status(conn, 'job')
+    assert status['status'] == 'completed'
+    assert 'request too large' in status['results'][0]['error']
+    assert main.breakers['vision'].snapshot()['failures'] == 0
+
+
+def test_batch_rejected_by_open_breaker_keeps_its_attempts(main, conn):
+    open_breaker(main.breakers['vision'])
+    add_job(conn, 'job', [b'a'])
+
+    for _ in range(main.MAX_JOB_ATTEMPTS + 2):
+        main.process_job_batch(conn, 'worker', main.claim_job_batch(conn, 'worker'))
+
+    assert job_rows(conn) == [('pending', 0)]
+    main.vision_client.batch_annotate_images.assert_not_called()